@@ -1,14 +1,36 @@
 import uvicorn
 import os
+import asyncio
+import contextlib
+import gzip
+import logging
+import mimetypes
+import shutil
+import tempfile
 from pathlib import Path
+import brotli
 from fastapi import FastAPI, HTTPException, Request
-from fastapi.responses import FileResponse, JSONResponse, RedirectResponse
+from fastapi.responses import (
+    FileResponse,
+    ORJSONResponse,
+    RedirectResponse,
+    Response,
+    StreamingResponse,
+)
 import mlflow
-from agent import AgentRequest, run_agent, reset_agent
+from agent import AgentRequest, ResetRequest, run_agent, reset_agent, stream_agent
 
-mlflow.pydantic_ai.autolog()
-mlflow.set_tracking_uri("/home/coder/smart-home/mlflow")
-_ = mlflow.set_experiment(f"{os.getenv('MLFLOW_EXPERIMENT_NAME', 'Smart Home Agent')}")
+logger = logging.getLogger(__name__)
+
+# Tracing the agent calls adds work to every request, so it is only enabled with MLFLOW_AUTOLOG=1
+if os.getenv("MLFLOW_AUTOLOG") == "1":
+    # Write the traces from a background thread instead of blocking the response
+    _ = os.environ.setdefault("MLFLOW_ENABLE_ASYNC_LOGGING", "true")
+    mlflow.pydantic_ai.autolog()
+    mlflow.set_tracking_uri("/home/coder/smart-home/mlflow")
+    _ = mlflow.set_experiment(
+        f"{os.getenv('MLFLOW_EXPERIMENT_NAME', 'Smart Home Agent')}"
+    )
 
 app = FastAPI()
 
@@ -16,28 +38,225 @@ SCRIPT_DIR = Path(__file__).parent.parent.absolute()
 BUILD_DIR = Path(SCRIPT_DIR / "whisper.cpp/build-em/bin/command.wasm").resolve()
 COI_WORKER_FILE = SCRIPT_DIR / "whisper.cpp/examples/coi-serviceworker.js"
 
+# Headers required for the cross-origin isolation (SharedArrayBuffer) used by whisper.cpp
+ISOLATION_HEADERS = {
+    "Cross-Origin-Opener-Policy": "same-origin",
+    "Cross-Origin-Embedder-Policy": "require-corp",
+    "Access-Control-Allow-Origin": "*",
+}
+
+
+# Text and WebAssembly files in the build output are compressed once at startup, so they never have
+# to be compressed per request. The encodings are listed in order of preference.
+COMPRESSIBLE_SUFFIXES = {".html", ".js", ".wasm"}
+ENCODING_SUFFIXES = {"br": ".br", "gzip": ".gz"}
+
+
+def compress_file(path: Path, encoding: str) -> Path | None:
+    compressed_path = path.with_name(path.name + ENCODING_SUFFIXES[encoding])
+    temporary_path: str | None = None
+    try:
+        if (
+            not compressed_path.is_file()
+            or compressed_path.stat().st_mtime_ns < path.stat().st_mtime_ns
+        ):
+            data = path.read_bytes()
+            compressed = (
+                brotli.compress(data, quality=11)
+                if encoding == "br"
+                else gzip.compress(data, compresslevel=9)
+            )
+            if len(compressed) >= len(data):
+                return None
+
+            # Write to a temporary file first, as several workers may compress the same file at once
+            with tempfile.NamedTemporaryFile(
+                dir=path.parent,
+                prefix=f"{compressed_path.name}.",
+                suffix=".tmp",
+                delete=False,
+            ) as temporary_file:
+                temporary_path = temporary_file.name
+                _ = temporary_file.write(compressed)
+            # NamedTemporaryFile only allows the owner to read the file
+            shutil.copymode(path, temporary_path)
+            os.replace(temporary_path, compressed_path)
+    except OSError as error:
+        # The variants are only an optimization, so a read-only or full build directory must not
+        # keep the file from being served uncompressed
+        logger.warning("Could not compress %s with %s: %s", path, encoding, error)
+        if temporary_path is not None:
+            with contextlib.suppress(OSError):
+                os.unlink(temporary_path)
+        return None
+
+    return compressed_path
+
+
+def parse_accept_encoding(accept_encoding: str) -> dict[str, float]:
+    qualities: dict[str, float] = {}
+    for coding in accept_encoding.split(","):
+        name, _, parameters = coding.partition(";")
+        quality = 1.0
+        for parameter in parameters.split(";"):
+            key, _, value = parameter.partition("=")
+            if key.strip().lower() == "q":
+                try:
+                    quality = float(value)
+                except ValueError:
+                    # An invalid q-value does not mark the encoding as acceptable
+                    quality = 0.0
+        name = name.strip().lower()
+        if name:
+            qualities[name] = quality
+    return qualities
+
+
+# Keeps references to the running background compressions, so they are not garbage collected
+COMPRESS_TASKS: set[asyncio.Task[None]] = set()
+
+
+class StaticFile:
+    def __init__(
+        self,
+        path: Path,
+        media_type: str | None = None,
+        encoding: str | None = None,
+        compress: bool = True,
+    ):
+        # Kept as a string, so responses do not need to convert the Path on every request
+        self.path: str = str(path)
+        self.media_type: str | None = media_type or mimetypes.guess_type(path.name)[0]
+        self.stat_result: os.stat_result = path.stat()
+        self.etag: str = (
+            f'W/"{self.stat_result.st_mtime_ns:x}-{self.stat_result.st_size:x}"'
+        )
+        self.headers: dict[str, str] = {
+            **ISOLATION_HEADERS,
+            # The file names do not change between builds, so browsers have to revalidate their
+            # cached copy, but only download the file again if the ETag has changed
+            "Cache-Control": "no-cache",
+            "ETag": self.etag,
+        }
+
+        self.variants: dict[str, StaticFile] = {}
+        # Only the build output is compressed, so no files are written into the whisper.cpp sources
+        self.compressible: bool = (
+            encoding is None
+            and path.parent == BUILD_DIR
+            and path.suffix in COMPRESSIBLE_SUFFIXES
+        )
+        if encoding is not None:
+            self.headers["Content-Encoding"] = encoding
+            self.headers["Vary"] = "Accept-Encoding"
+        elif self.compressible:
+            self.headers["Vary"] = "Accept-Encoding"
+            if compress:
+                self.compress_variants()
+
+    def compress_variants(self) -> None:
+        path = Path(self.path)
+        variants: dict[str, StaticFile] = {}
+        for encoding in ENCODING_SUFFIXES:
+            compressed_path = compress_file(path, encoding)
+            if compressed_path is not None:
+                variants[encoding] = StaticFile(
+                    compressed_path, self.media_type, encoding
+                )
+        # Assigned at once, as this may run in a thread while responses read the variants
+        self.variants = variants
+
+    def refreshed(self) -> "StaticFile | None":
+        # The build may replace a file while the server is running, which would make the stat result
+        # (and the compressed variants) outdated. Comparing against a single stat call is still
+        # cheaper than the stat FileResponse otherwise runs in a thread for every request.
+        try:
+            stat_result = os.stat(self.path)
+        except FileNotFoundError:
+            return None
+        if (
+            stat_result.st_mtime_ns == self.stat_result.st_mtime_ns
+            and stat_result.st_size == self.stat_result.st_size
+        ):
+            return self
+
+        try:
+            static_file = StaticFile(Path(self.path), self.media_type, compress=False)
+        except FileNotFoundError:
+            return None
+        if static_file.compressible:
+            # The file is served uncompressed until its variants are ready, instead of letting the
+            # request wait for brotli. This method does not await anything, so the caller replaces
+            # the entry before another request can see the change and compress the file again.
+            task = asyncio.create_task(asyncio.to_thread(static_file.compress_variants))
+            COMPRESS_TASKS.add(task)
+            task.add_done_callback(COMPRESS_TASKS.discard)
+        return static_file
+
+    def response(self, request: Request) -> Response:
+        static_file = self
+        if self.variants:
+            qualities = parse_accept_encoding(
+                request.headers.get("accept-encoding", "")
+            )
+            # "*" covers all encodings that are not listed explicitly. Among the accepted encodings
+            # the order of ENCODING_SUFFIXES is used instead of the q-values, as brotli is smaller
+            default_quality = qualities.get("*", 0.0)
+            for encoding, variant in self.variants.items():
+                if qualities.get(encoding, default_quality) > 0:
+                    static_file = variant
+                    break
+
+        if_none_match = request.headers.get("if-none-match")
+        if if_none_match is not None and static_file.etag in (
+            tag.strip() for tag in if_none_match.split(",")
+        ):
+            return Response(status_code=304, headers=static_file.headers)
+
+        return FileResponse(
+            static_file.path,
+            media_type=static_file.media_type,
+            headers=static_file.headers,
+            stat_result=static_file.stat_result,
+        )
+
+
+# The files that may be served are collected once instead of resolving every requested path, so
+# files added to the build output after startup are only served after a restart
+WHISPER_FILES: dict[str, StaticFile] = (
+    {
+        path.name: StaticFile(path)
+        for path in BUILD_DIR.iterdir()
+        if path.is_file()
+        and path.resolve().parent == BUILD_DIR
+        and path.suffix not in ENCODING_SUFFIXES.values()
+        and not path.name.endswith(".tmp")
+    }
+    if BUILD_DIR.is_dir()
+    else {}
+)
+COI_WORKER = (
+    StaticFile(COI_WORKER_FILE, media_type="application/javascript")
+    if COI_WORKER_FILE.is_file()
+    else None
+)
+
 
 # Serve all .js, .worker.js files from build directory
 @app.get(f"/whisper/{{file_path:path}}")
-async def serve_static_files(_: Request, file_path: str):
-    full_path = BUILD_DIR / file_path
-
+async def serve_static_files(request: Request, file_path: str):
     if file_path == "":
         return RedirectResponse(url=f"index.html")
 
-    if not full_path.resolve().parent == BUILD_DIR.resolve():
-        raise HTTPException(status_code=400, detail="Invalid file path")
+    static_file = WHISPER_FILES.get(file_path)
+    if static_file is not None:
+        static_file = static_file.refreshed()
+    if static_file is None:
+        # The entry is kept, so the file is served again once the build has recreated it
+        raise HTTPException(status_code=404, detail="File not found")
 
-    if full_path.exists() and full_path.is_file():
-        return FileResponse(
-            full_path,
-            headers={
-                "Cross-Origin-Opener-Policy": "same-origin",
-                "Cross-Origin-Embedder-Policy": "require-corp",
-                "Access-Control-Allow-Origin": "*",
-            },
-        )
-    raise HTTPException(status_code=404, detail="File not found")
+    WHISPER_FILES[file_path] = static_file
+    return static_file.response(request)
 
 
 @app.get("/")
@@ -46,36 +265,49 @@ async def redirect_root():
 
 
 @app.get("/coi-serviceworker.js")
-async def serve_coi_worker():
-    if COI_WORKER_FILE.exists():
-        return FileResponse(
-            COI_WORKER_FILE,
-            media_type="application/javascript",
-            headers={
-                "Cross-Origin-Opener-Policy": "same-origin",
-                "Cross-Origin-Embedder-Policy": "require-corp",
-                "Access-Control-Allow-Origin": "*",
-            },
-        )
-    raise HTTPException(status_code=404, detail="coi-serviceworker.js not found")
+async def serve_coi_worker(request: Request):
+    global COI_WORKER
+    static_file = None if COI_WORKER is None else COI_WORKER.refreshed()
+    if static_file is None:
+        raise HTTPException(status_code=404, detail="coi-serviceworker.js not found")
+
+    COI_WORKER = static_file
+    return static_file.response(request)
 
 
 @app.post(path="/converse")
-async def converse(request: AgentRequest) -> JSONResponse:
+async def converse(request: AgentRequest) -> ORJSONResponse:
     response = await run_agent(request)
-    return JSONResponse(response)
+    return ORJSONResponse(response)
+
+
+# Same as /converse, but sends the response text as server-sent events while it is generated
+@app.post(path="/converse/stream")
+async def converse_stream(request: AgentRequest) -> StreamingResponse:
+    async def events():
+        async for text in stream_agent(request):
+            # Every line of a multi-line chunk needs its own data field
+            yield "".join(f"data: {line}\n" for line in text.split("\n")) + "\n"
+
+    return StreamingResponse(events(), media_type="text/event-stream")
 
 
 @app.post(path="/reset")
-async def reset() -> JSONResponse:
-    await reset_agent()
-    return JSONResponse("{'status': 'ok'}")
+async def reset(request: ResetRequest = ResetRequest()) -> ORJSONResponse:
+    await reset_agent(request.session_id)
+    return ORJSONResponse({"status": "ok"})
 
 
 if __name__ == "__main__":
     uvicorn.run(
         "main:app",
-        reload=True,
-        log_level="debug",
+        # Picks uvloop and httptools from uvicorn[standard] where they are available
+        loop="auto",
+        http="auto",
+        # Conversations are kept in memory, so all turns of a session need to reach the same worker
+        workers=int(os.getenv("UVICORN_WORKERS", "1")),
+        reload=os.getenv("UVICORN_RELOAD") == "1",
+        log_level=os.getenv("UVICORN_LOG_LEVEL", "warning"),
+        access_log=os.getenv("UVICORN_ACCESS_LOG") == "1",
         port=int(os.getenv("UVICORN_PORT", "8912")),
     )
@@ -1,4 +1,5 @@
 #!/bin/bash
 export UVICORN_PORT=$1
 export MLFLOW_EXPERIMENT_NAME=$2
+# Tracing to MLflow is only enabled when MLFLOW_AUTOLOG=1 is set when calling the script
 uv run --prerelease=allow main.py
\ No newline at end of file
@@ -1,14 +1,30 @@
 import os
+import asyncio
+import logging
 import textwrap
 import datetime
-from dirigera.devices.outlet import Outlet
-from dirigera.devices.controller import Controller
-from dirigera.devices.light import Light
+import functools
+import httpx
+from collections import OrderedDict
+from collections.abc import AsyncIterator
+from typing import Any, Callable
+from dirigera.devices.outlet import Outlet, dict_to_outlet
+from dirigera.devices.controller import Controller, dict_to_controller
+from dirigera.devices.light import Light, dict_to_light
 from pydantic import BaseModel, Field
 from pydantic_ai import Agent, RunContext
-from pydantic_ai.messages import ModelMessage
+from pydantic_ai.models.openai import OpenAIModel
+from pydantic_ai.providers.openai import OpenAIProvider
+from pydantic_ai.messages import (
+    ModelMessage,
+    ModelRequest,
+    SystemPromptPart,
+    UserPromptPart,
+)
 from dirigera.hub.hub import Hub
 
+logger = logging.getLogger(__name__)
+
 ###############################################################################
 ### Program variables: Update in accordance with workshop instructions!     ###
 ###############################################################################
@@ -25,18 +41,23 @@ enable_dirigera = False
 ###############################################################################
 class AgentRequest(BaseModel):
     prompt: str
+    session_id: str = "default"
+
+
+class ResetRequest(BaseModel):
+    session_id: str = "default"
 
 
 class LightStatus(BaseModel):
     is_on: bool | None = Field(description="Whether the lights are on or off")
     light_level: int | None = Field(
         description="Brightness of the lights from 1 (lowest) to 100 (highest)",
-        ge=0,
+        ge=1,
         le=100,
         default=100,
     )
     light_hue: float | None = Field(
-        description="Hue of the lights from 0 to 360", ge=0, le=100, default=0
+        description="Hue of the lights from 0 to 360", ge=0, le=360, default=0
     )
     light_saturation: float | None = Field(
         description="Saturation of the lights from 0 to 1", ge=0, le=1, default=1
@@ -48,6 +69,18 @@ class LightStatus(BaseModel):
 ########################################################################################
 
 
+def find_device(
+    all_devices: list[dict[str, Any]], device_type: str, name: str
+) -> dict[str, Any]:
+    for device in all_devices:
+        if (
+            device["type"] == device_type
+            and device["attributes"].get("customName") == name
+        ):
+            return device
+    raise AssertionError(f"No {device_type} found with name {name}")
+
+
 class DeviceDeps:
     def __init__(self, has_dirigera: bool = True):
         self.has_dirigera: bool = has_dirigera
@@ -57,17 +90,22 @@ class DeviceDeps:
                 ip_address="host.docker.internal",
             )
 
-            self.desk_lamp_outlet: Outlet = self.dirigera_hub.get_outlet_by_name(
-                outlet_name="Tischlampe"
+            # The get_*_by_name helpers each fetch the full device list, so fetch it only once.
+            # The device attributes are kept locally and updated by the setters afterwards.
+            all_devices: list[dict[str, Any]] = self.dirigera_hub.get("/devices")
+
+            self.desk_lamp_outlet: Outlet = dict_to_outlet(
+                find_device(all_devices, "outlet", "Tischlampe"), self.dirigera_hub
             )
-            self.light_chain_outlet: Outlet = self.dirigera_hub.get_outlet_by_name(
-                outlet_name="Fotolicht"
+            self.light_chain_outlet: Outlet = dict_to_outlet(
+                find_device(all_devices, "outlet", "Fotolicht"), self.dirigera_hub
             )
-            self.room_lights: Light = self.dirigera_hub.get_light_by_name(
-                lamp_name="Licht 1"
+            self.room_lights: Light = dict_to_light(
+                find_device(all_devices, "light", "Licht 1"), self.dirigera_hub
             )
-            self.remote_control: Controller = self.dirigera_hub.get_controller_by_name(
-                controller_name="Fernbedienung"
+            self.remote_control: Controller = dict_to_controller(
+                find_device(all_devices, "controller", "Fernbedienung"),
+                self.dirigera_hub,
             )
 
     def desk_lamp_status(self) -> str:
@@ -106,11 +144,43 @@ class DeviceDeps:
 ### Agent Configuration: Creates and calls the Agent itself                          ###
 ########################################################################################
 
-all_messages: list[ModelMessage] | None = None
+# Maximum number of conversations kept in memory, the least recently used one is dropped first
+max_sessions = 64
+
+# Once a conversation exceeds max_history_turns, all but the last kept_history_turns turns are
+# replaced by a summary. Compacting several turns at once keeps the prompt prefix stable in between.
+max_history_turns = 12
+kept_history_turns = 6
+
+
+class Session:
+    def __init__(self):
+        self.messages: list[ModelMessage] | None = None
+        # Number of turns in messages, counted as they are added instead of scanning the history
+        self.turns: int = 0
+        self.summary: SystemPromptPart | None = None
+        self.compaction: asyncio.Task[None] | None = None
+        # Serializes the turns of a single conversation, independent sessions run concurrently
+        self.lock: asyncio.Lock = asyncio.Lock()
+
+
+sessions: OrderedDict[str, Session] = OrderedDict()
 devices: DeviceDeps = DeviceDeps(has_dirigera=enable_dirigera)
 
+# A single long-lived HTTP client for all model requests, keeping enough connections alive for
+# the concurrent sessions so the TCP and TLS handshakes are not repeated for every turn
+model = OpenAIModel(
+    "gpt-4o",
+    provider=OpenAIProvider(
+        http_client=httpx.AsyncClient(
+            timeout=httpx.Timeout(timeout=600, connect=5),
+            limits=httpx.Limits(max_keepalive_connections=max_sessions),
+        )
+    ),
+)
+
 agent = Agent(
-    "openai:gpt-4o",
+    model,
     deps_type=DeviceDeps,
     system_prompt=textwrap.dedent(
         """
@@ -120,20 +190,141 @@ agent = Agent(
     ),
 )
 
+summary_agent = Agent(
+    model,
+    instructions=textwrap.dedent(
+        """
+            Summarize the conversation between the user and the smart-home assistant.
+            Keep all user preferences and facts that could be relevant later on, but omit small talk.
+        """
+    ),
+)
+
 
 async def run_agent(req: AgentRequest) -> str:
     if not enable_agent:
         return f"Echo: {req.prompt}"
     else:
-        global all_messages
-        result = await agent.run(req.prompt, deps=devices, message_history=all_messages)
-        all_messages = result.all_messages()
+        session = get_session(req.session_id)
+        async with session.lock:
+            # The device status is sent along with the prompt rather than in the instructions,
+            # which keeps the prompt prefix identical across turns so it can be served from the
+            # provider's prompt cache (OpenAI, or vLLM/SGLang with prefix caching enabled).
+            result = await agent.run(
+                [get_device_status(devices), req.prompt],
+                deps=devices,
+                message_history=session.messages,
+            )
+            store_messages(session, result.all_messages())
         return result.output
 
 
-async def reset_agent() -> None:
-    global all_messages
-    all_messages = None
+async def stream_agent(req: AgentRequest) -> AsyncIterator[str]:
+    if not enable_agent:
+        yield f"Echo: {req.prompt}"
+    else:
+        session = get_session(req.session_id)
+        async with session.lock:
+            async with agent.run_stream(
+                [get_device_status(devices), req.prompt],
+                deps=devices,
+                message_history=session.messages,
+            ) as result:
+                async for text in result.stream_text(delta=True):
+                    yield text
+            # Only update the history once the full response has been sent
+            store_messages(session, result.all_messages())
+
+
+def store_messages(session: Session, messages: list[ModelMessage]) -> None:
+    # pydantic-ai hands out its own message list without copying it, so it is stored as is
+    session.messages = messages
+    session.turns += 1
+    if session.turns > max_history_turns and (
+        session.compaction is None or session.compaction.done()
+    ):
+        # Compact in the background so the reply is not delayed by the summary request
+        session.compaction = asyncio.create_task(compact_history(session))
+
+
+def get_turn_starts(messages: list[ModelMessage]) -> list[int]:
+    return [
+        index
+        for index, message in enumerate(messages)
+        if isinstance(message, ModelRequest)
+        and any(isinstance(part, UserPromptPart) for part in message.parts)
+    ]
+
+
+async def compact_history(session: Session) -> None:
+    # The lock is only held while reading and updating the history, not during the summary
+    # request, so the next turn of the session does not have to wait for it. This works because
+    # turns are only ever appended to the history while the summary is created.
+    async with session.lock:
+        messages = session.messages
+        if messages is None:
+            return
+
+        turn_starts = get_turn_starts(messages)
+        session.turns = len(turn_starts)
+        if session.turns <= max_history_turns:
+            return
+
+        # Only split at the start of a turn, so no tool call gets separated from its result
+        split = turn_starts[-kept_history_turns]
+        summarized_messages = messages[:split]
+        summarized_turns = len(turn_starts) - kept_history_turns
+        previous_summary = session.summary
+
+    try:
+        result = await summary_agent.run(
+            "Summarize the conversation so far.",
+            message_history=summarized_messages,
+        )
+    except Exception:
+        logger.exception("Failed to summarize the conversation history")
+        return
+
+    system_prompt = [
+        part
+        for part in summarized_messages[0].parts
+        if isinstance(part, SystemPromptPart) and part is not previous_summary
+    ]
+    summary = SystemPromptPart(
+        content=f"Summary of the earlier conversation: {result.output}"
+    )
+
+    async with session.lock:
+        messages = session.messages
+        if (
+            messages is None
+            or len(messages) < split
+            or messages[split - 1] is not summarized_messages[-1]
+        ):
+            # The history was replaced in the meantime, so the summary no longer applies
+            return
+
+        session.summary = summary
+        session.messages = [
+            ModelRequest(parts=[*system_prompt, summary]),
+            *messages[split:],
+        ]
+        session.turns -= summarized_turns
+
+
+def get_session(session_id: str) -> Session:
+    session = sessions.get(session_id)
+    if session is None:
+        session = sessions[session_id] = Session()
+        if len(sessions) > max_sessions:
+            _ = sessions.popitem(last=False)
+    else:
+        sessions.move_to_end(session_id)
+    return session
+
+
+async def reset_agent(session_id: str) -> None:
+    _ = sessions.pop(session_id, None)
 
 
 ########################################################################################
@@ -141,50 +332,84 @@ async def reset_agent() -> None:
 ########################################################################################
 
 
+# The prompt texts are constant, so they are only dedented once when the module is loaded
+available_devices_instructions = textwrap.dedent(
+    """
+    You currently have access to the following devices:
+    - A small desk lamp, controlled through the tool "toggle_desk_light".
+    - A light chain, controlled through the tool "toggle_light_chain".
+    - A set of room lights, controlled through the tool "toggle_room_lights"
+
+    The current status of these devices is reported together with each user query.
+    Make use of these tools to control the smart-home devices and answer the user's queries.
+
+    In addition to the device controls, you have access to a tool "get_current_time"
+    for accessing the current date and time.
+    """
+)
+
+device_status_template = textwrap.dedent(
+    """
+    Current device status:
+    - The desk lamp is {desk_lamp}.
+    - The light chain is {light_chain}.
+    - The room lights are {room_lights}.
+    """
+)
+
+
 @agent.instructions
-def get_available_devices(ctx: RunContext[DeviceDeps]) -> str:
-    return textwrap.dedent(
-        f"""
-        You currently have access to the following devices:
-        - A small desk lamp, controlled through the tool "toggle_desk_light".
-          This desk lamp is currently {ctx.deps.desk_lamp_status()}.
-        - A light chain, controlled through the tool "toggle_light_chain".
-          This light chain is currently {ctx.deps.light_chain_status()}.
-        - A set of room lights, controlled through the tool "toggle_room_lights"
-          The room lights are currently {ctx.deps.room_lights_status()}.
-
-        Make use of these tools to control the smart-home devices and answer the user's queries.
-
-        In addition to the device controls, you have access to a tool "get_current_time"
-        for accessing the current date and time.
-        """
+def get_available_devices(_: RunContext[DeviceDeps]) -> str:
+    return available_devices_instructions
+
+
+def get_device_status(deps: DeviceDeps) -> str:
+    return device_status_template.format(
+        desk_lamp=deps.desk_lamp_status(),
+        light_chain=deps.light_chain_status(),
+        room_lights=deps.room_lights_status(),
     )
 
 
-@agent.tool
-def toggle_desk_light(ctx: RunContext[DeviceDeps], is_on: bool) -> None:
+def device_tool(offline_output: Any = None) -> Callable[[Callable], Callable]:
+    # Whether the hub is used is fixed at startup, so the device tools are specialized once:
+    # without the hub, a stand-in with the same signature and description is registered,
+    # which only returns offline_output
+    def register(function: Callable) -> Callable:
+        if enable_dirigera:
+            return agent.tool(function)
+
+        @functools.wraps(function)
+        async def offline_function(*_args: Any, **_kwargs: Any) -> Any:
+            return offline_output
+
+        return agent.tool(offline_function)
+
+    return register
+
+
+@device_tool()
+async def toggle_desk_light(ctx: RunContext[DeviceDeps], is_on: bool) -> None:
     """Turn the desk light on or off
 
     Args:
         is_on: True to turn on the lamp, False to turn it off.
     """
-    if ctx.deps.has_dirigera:
-        ctx.deps.desk_lamp_outlet.set_on(is_on)
+    await asyncio.to_thread(ctx.deps.desk_lamp_outlet.set_on, is_on)
 
 
-@agent.tool
-def toggle_light_chain(ctx: RunContext[DeviceDeps], is_on: bool) -> None:
+@device_tool()
+async def toggle_light_chain(ctx: RunContext[DeviceDeps], is_on: bool) -> None:
     """Turn the light chain on or off
 
     Args:
         is_on: True to turn on the lamp, False to turn it off.
     """
-    if ctx.deps.has_dirigera:
-        ctx.deps.light_chain_outlet.set_on(is_on)
+    await asyncio.to_thread(ctx.deps.light_chain_outlet.set_on, is_on)
 
 
-@agent.tool
-def toggle_room_lights(
+@device_tool(offline_output=LightStatus(is_on=False))
+async def toggle_room_lights(
     ctx: RunContext[DeviceDeps], new_status: LightStatus
 ) -> LightStatus:
     """Change color and brightness of the room lights
@@ -192,28 +417,45 @@ def toggle_room_lights(
     Args:
         new_status: Desired status of the room lights.
     """
-    if ctx.deps.has_dirigera:
-        if new_status.is_on is not None:
-            ctx.deps.room_lights.set_light(new_status.is_on)
+    room_lights = ctx.deps.room_lights
 
-        if new_status.light_level is not None:
-            ctx.deps.room_lights.set_light_level(new_status.light_level)
+    attributes: dict[str, Any] = {}
+    if new_status.is_on is not None:
+        attributes["isOn"] = new_status.is_on
 
-        if new_status.light_hue is not None and new_status.light_saturation is not None:
-            ctx.deps.room_lights.set_light_color(
-                new_status.light_hue, new_status.light_saturation
-            )
+    if new_status.light_level is not None:
+        attributes["lightLevel"] = new_status.light_level
 
-        new_attributes = ctx.deps.room_lights.attributes
+    if new_status.light_hue is not None and new_status.light_saturation is not None:
+        attributes["colorHue"] = new_status.light_hue
+        attributes["colorSaturation"] = new_status.light_saturation
 
-        return LightStatus(
-            is_on=new_attributes.is_on,
-            light_level=new_attributes.light_level,
-            light_hue=new_attributes.color_hue,
-            light_saturation=new_attributes.color_saturation,
+    if attributes:
+        # Change all attributes with a single request to the hub instead of one per setter
+        _ = await asyncio.to_thread(
+            ctx.deps.dirigera_hub.patch,
+            route=f"/devices/{room_lights.id}",
+            data=[{"attributes": attributes}],
         )
-    else:
-        return LightStatus(is_on=False)
+
+    # The hub does not return the new state, so the local attributes are updated like the
+    # setters of the dirigera SDK do
+    if "isOn" in attributes:
+        room_lights.attributes.is_on = attributes["isOn"]
+    if "lightLevel" in attributes:
+        room_lights.attributes.light_level = attributes["lightLevel"]
+    if "colorHue" in attributes:
+        room_lights.attributes.color_hue = attributes["colorHue"]
+        room_lights.attributes.color_saturation = attributes["colorSaturation"]
+
+    new_attributes = room_lights.attributes
+
+    return LightStatus(
+        is_on=new_attributes.is_on,
+        light_level=new_attributes.light_level,
+        light_hue=new_attributes.color_hue,
+        light_saturation=new_attributes.color_saturation,
+    )
 
 
 @agent.tool
@@ -222,14 +464,5 @@ def get_current_time(_: RunContext[DeviceDeps]) -> str:
     # Get current date and time
     now = datetime.datetime.now()
 
-    # Extract parts
-    weekday = now.strftime("%A")
-    day = now.day
-    month = now.strftime("%B")
-    year = now.year
-    hour = now.strftime("%I")
-    minute = now.strftime("%M")
-    am_pm = now.strftime("%p")
-
-    # Format output
-    return f"Today is {weekday}, {day}. {month} {year}. It is currently {hour}:{minute}{am_pm}."
+    # Format output, the day is inserted directly as strftime has no portable unpadded day
+    return now.strftime(f"Today is %A, {now.day}. %B %Y. It is currently %I:%M%p.")